@@ -1,4 +1,7 @@
+import asyncio
 import logging
+import time
+from collections import OrderedDict
 
 from dotenv import load_dotenv
 
@@ -16,18 +19,70 @@ from livekit.agents import (
 )
 from livekit.agents.llm import function_tool
 from livekit.agents.voice import MetricsCollectedEvent
-from livekit.plugins import deepgram, openai, silero, turn_detector, elevenlabs
+from livekit.plugins import deepgram, openai, silero, turn_detector
 from livekit.plugins import noise_cancellation
 from livekit.plugins.turn_detector.multilingual import MultilingualModel
 from livekit.plugins import silero
 import os
 
+from src.tts import open_tts
+from src.warmup import warm_up_llm
+
 # Logger for this module
 logger = logging.getLogger("basic-agent")
 
 # Load environment variables from .env file
 load_dotenv(dotenv_path=".env")
 
+# Weather responses are cached on a 0.1° grid (~11 km) for this many seconds,
+# keeping at most WEATHER_CACHE_SIZE grid cells (least recently used evicted)
+WEATHER_CACHE_TTL = 600
+WEATHER_CACHE_SIZE = 256
+_weather_cache: OrderedDict[tuple[float, float], tuple[float, dict]] = OrderedDict()
+
+
+async def fetch_weather(latitude: str, longitude: str) -> dict:
+    """
+    Fetches the current weather for the given coordinates.
+
+    Dummy response for now – here you would integrate a real weather API,
+    using the job's pooled HTTP session (`livekit.agents.utils.http_context`)
+    so connections are reused across tool calls.
+    """
+    return {
+        "weather": "sunny",
+        "temperature": 70,
+    }
+
+
+async def cached_weather(latitude: str, longitude: str) -> dict:
+    """
+    Returns the weather for the coordinates, reusing a previous response for
+    the same grid cell if it is younger than WEATHER_CACHE_TTL.
+
+    Coordinates come from the LLM as free text; if they are not plain numbers
+    (e.g. "40.4° N") the lookup is done without the cache.
+    """
+    try:
+        key = (round(float(latitude), 1), round(float(longitude), 1))
+    except ValueError:
+        return await fetch_weather(latitude, longitude)
+
+    now = time.monotonic()
+    cached = _weather_cache.get(key)
+    if cached is not None:
+        if now - cached[0] < WEATHER_CACHE_TTL:
+            _weather_cache.move_to_end(key)
+            return cached[1]
+        del _weather_cache[key]
+
+    weather = await fetch_weather(latitude, longitude)
+    _weather_cache[key] = (now, weather)
+    if len(_weather_cache) > WEATHER_CACHE_SIZE:
+        _weather_cache.popitem(last=False)
+    return weather
+
+
 class AgenteValley(Agent):
     """
     Main conversational agent class.
@@ -78,28 +133,26 @@ class AgenteValley(Agent):
             longitude: Estimated longitude of the location.
 
         Returns:
-            A simple fake weather payload. In a real implementation, this
-            would call an external weather API.
+            The weather payload for the location, cached by coordinates
+            (see `cached_weather`).
         """
 
         logger.info(f"Looking up weather for {location}")
 
-        # Dummy response for now – here you would integrate a real weather API
-        return {
-            "weather": "sunny",
-            "temperature": 70,
-            "location": location,
-        }
+        weather = await cached_weather(latitude, longitude)
+        return {**weather, "location": location}
 
 
 def prewarm(proc: JobProcess):
     """
     Prewarm function executed when the worker starts.
 
-    It loads heavy/shared resources once (here: the Silero VAD model)
-    and stores them in `proc.userdata` so they can be reused by sessions.
+    It loads heavy/shared resources once (here: the Silero VAD model and
+    the OpenAI client) and stores them in `proc.userdata` so they can be
+    reused by sessions.
     """
     proc.userdata["vad"] = silero.VAD.load()
+    proc.userdata["llm"] = openai.LLM(model="gpt-4o-mini", temperature=0.4)
 
 
 async def entrypoint(ctx: JobContext):
@@ -113,42 +166,74 @@ async def entrypoint(ctx: JobContext):
     - Waiting for a participant
     - Starting the voice agent
     """
+    # Open the OpenAI connection in the background while we connect to the
+    # room and wait for the user
+    llm = ctx.proc.userdata["llm"]
+    warm_up_task = asyncio.create_task(warm_up_llm(llm))
+
     # Connect this worker to the LiveKit room
     await ctx.connect()
 
     # Create the AgentSession that will handle audio + LLM + TTS
     session = AgentSession(
         vad=ctx.proc.userdata["vad"],  # Use preloaded VAD from prewarm
-        # LLM used for reasoning and generation
-        llm=openai.LLM(model="gpt-4o-mini", temperature=0.4),
-        # Speech-to-text via Deepgram
+        # LLM used for reasoning and generation (created in prewarm)
+        llm=llm,
+        # Speech-to-text via Deepgram (per job: it uses the job's HTTP session)
         stt=deepgram.STT(model="nova-3-general", language="es"),
         # Text-to-speech via ElevenLabs
-        tts=elevenlabs.TTS(
+        tts=await open_tts(
             voice_id="Ir1QNHvhaJXbAGhT50w3",
             model="eleven_turbo_v2_5",
-        ),
+        ),  # Opens the WebSocket before the session starts
         # Turn detection model to know when user finished talking
         turn_detection=MultilingualModel(),
+        # Start LLM generation on interim transcripts, before the turn is confirmed
+        preemptive_generation=True,
+        # Minimal silence before ending the turn; the turn detector is the main signal
+        min_endpointing_delay=0.05,
     )
 
     # Collector to accumulate usage / cost metrics during the session
     usage_collector = metrics.UsageCollector()
 
+    # Metrics waiting to be logged by the background task below
+    metrics_queue: asyncio.Queue[metrics.AgentMetrics] = asyncio.Queue(maxsize=256)
+
+    async def _log_metrics_worker():
+        """
+        Background task that logs queued metrics in a worker thread,
+        keeping logging I/O out of the event loop that handles audio.
+        """
+        while True:
+            agent_metrics = await metrics_queue.get()
+            await asyncio.to_thread(metrics.log_metrics, agent_metrics)
+
+    log_metrics_task = asyncio.create_task(_log_metrics_worker())
+
     @session.on("metrics_collected")
     def _on_metrics_collected(ev: MetricsCollectedEvent):
         """
         Callback triggered whenever metrics are emitted by the session.
 
-        Logs metrics in real time and aggregates them in the usage collector.
+        Aggregates them in the usage collector (cheap, done inline) and
+        queues them to be logged by the background task.
         """
-        metrics.log_metrics(ev.metrics)
         usage_collector.collect(ev.metrics)
+        try:
+            metrics_queue.put_nowait(ev.metrics)
+        except asyncio.QueueFull:
+            logger.debug("metrics queue full, skipping metrics log")
 
     async def log_usage():
         """
         Shutdown callback to log a summary of usage when the session ends.
         """
+        log_metrics_task.cancel()
+        # Log whatever the background task didn't get to, so the last turn isn't lost
+        while not metrics_queue.empty():
+            metrics.log_metrics(metrics_queue.get_nowait())
+        warm_up_task.cancel()
         summary = usage_collector.get_summary()
         logger.info(f"Usage: {summary}")
 
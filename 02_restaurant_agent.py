@@ -1,15 +1,23 @@
+import asyncio
+import functools
 import logging
-from typing import Annotated
+import re
+from collections import deque
+from typing import Annotated, Optional
 
 from dotenv import load_dotenv
 from pydantic import Field
+from src.llm_cache import CachedLLM
 from src.models import UserData
+from src.tts import open_tts
+from src.warmup import warm_up_llm
 
-from livekit.agents import JobContext, WorkerOptions, cli, llm
+from livekit.agents import JobContext, JobProcess, WorkerOptions, cli, llm
 from livekit.agents.llm import function_tool
 from livekit.agents.voice import Agent, AgentSession, RunContext
 from livekit.agents.voice.room_io import RoomInputOptions
 from livekit.plugins import deepgram, openai, silero, elevenlabs, turn_detector, noise_cancellation
+from livekit.plugins.turn_detector.multilingual import MultilingualModel
 import os
 
 # Logger específico para este agente/restaurante
@@ -22,6 +30,28 @@ load_dotenv(dotenv_path=".env")
 # Alias de tipo para el RunContext que utiliza nuestro UserData
 RunContext_T = RunContext[UserData]
 
+# Configuración de voz de ElevenLabs común a todos los agentes: cambiar la voz
+# o el modelo se hace sólo aquí. Crea un TTS nuevo para el job actual.
+make_tts = functools.partial(
+    open_tts,
+    voice_id="Ir1QNHvhaJXbAGhT50w3",
+    model="eleven_turbo_v2_5",
+)
+
+# Tipos de item del chat_ctx que corresponden a llamadas a tools
+_FC_TYPES = frozenset({"function_call", "function_call_output"})
+
+# Palabras de menos de 4 letras (artículos, preposiciones...) no aportan relevancia
+_WORD_RE = re.compile(r"\w{4,}")
+
+
+def _tokenize(text: str) -> frozenset[str]:
+    """
+    Conjunto de palabras (en minúsculas) de un texto. No se cachea: los textos
+    incluyen datos del usuario que no deben sobrevivir a la sesión.
+    """
+    return frozenset(_WORD_RE.findall(text.lower()))
+
 
 # ====================== #
 #   TOOLS COMUNES       #
@@ -78,28 +108,36 @@ class BaseAgent(Agent):
       - Añadir un mensaje de sistema con el resumen de datos del usuario.
     """
 
+    # Id del turno (speech handle) en el que este agente ya ha hecho una transferencia
+    _transfer_speech_id: Optional[str] = None
+
     async def on_enter(self) -> None:
         agent_name = self.__class__.__name__
         logger.info(f"entering task {agent_name}")
 
         userdata: UserData = self.session.userdata
-        chat_ctx = self.chat_ctx.copy()
+        # self.chat_ctx es de sólo lectura: basta una copia superficial de la lista
+        # de items (ChatContext.copy() además recorre cada item aplicando filtros)
+        chat_ctx = llm.ChatContext(list(self.chat_ctx.items))
 
         # Si venimos de otro agente, copiamos parte de su chat_ctx
         if userdata.prev_agent:
             items_copy = self._truncate_chat_ctx(
                 userdata.prev_agent.chat_ctx.items,
                 keep_function_call=True,
+                relevance_context=self.instructions,
             )
             # Evitar duplicar mensajes con el mismo id
             existing_ids = {item.id for item in chat_ctx.items}
-            items_copy = [item for item in items_copy if item.id not in existing_ids]
-            chat_ctx.items.extend(items_copy)
+            chat_ctx.items.extend(item for item in items_copy if item.id not in existing_ids)
 
-        # Añade un mensaje de sistema con datos del usuario (resumen)
+        # Añade un mensaje de sistema con datos del usuario (resumen).
+        # Va siempre al final, después del historial: las instrucciones estáticas
+        # quedan al principio y el prefijo del prompt no cambia entre llamadas,
+        # así OpenAI puede reutilizarlo con su caché automática de prompts.
         chat_ctx.add_message(
             role="system",
-            content=f"Eres el agente {agent_name}. Los datos actuales del usuario son {userdata.summarize()}",
+            content=f"Eres el agente {agent_name}. Los datos actuales del usuario son {userdata.cached_summary()}",
         )
         # Actualiza el contexto de chat del agente
         await self.update_chat_ctx(chat_ctx)
@@ -107,12 +145,19 @@ class BaseAgent(Agent):
         # Genera una respuesta inicial de forma automática
         self.session.generate_reply(tool_choice="none")
 
-    async def _transfer_to_agent(self, name: str, context: RunContext_T) -> tuple[Agent, str]:
+    async def _transfer_to_agent(self, name: str, context: RunContext_T) -> str | tuple[Agent, str]:
         """
         Lógica común de transferencia entre agentes.
         Guarda el agente actual en userdata.prev_agent
         y devuelve el siguiente agente junto con un mensaje.
+        Sólo se permite una transferencia por turno: si el LLM pide varias
+        en paralelo, gana la primera y el resto se ignoran.
         """
+        speech_id = context.speech_handle.id
+        if self._transfer_speech_id == speech_id:
+            return f"Transfer to {name} ignored, another transfer is already in progress."
+        self._transfer_speech_id = speech_id
+
         userdata = context.userdata
         current_agent = context.session.current_agent
         next_agent = userdata.agents[name]
@@ -126,44 +171,105 @@ class BaseAgent(Agent):
         keep_last_n_messages: int = 6,
         keep_system_message: bool = False,
         keep_function_call: bool = False,
+        relevance_context: Optional[str] = None,
+        keep_relevant_n: int = 2,
     ) -> list[llm.ChatItem]:
         """
         Recorta el historial de conversación para mantener sólo los últimos N mensajes,
         con opciones para conservar mensajes de sistema y/o de function_call.
+        Si se pasa `relevance_context` (p. ej. las instrucciones del nuevo agente),
+        hasta `keep_relevant_n` de esos N huecos se dedican a mensajes anteriores
+        relevantes para ese contexto, así el total nunca supera N.
         """
 
         def _valid_item(item: llm.ChatItem) -> bool:
-            if not keep_system_message and item.type == "message" and item.role == "system":
+            itm_type = item.type
+            if not keep_system_message and itm_type == "message" and item.role == "system":
                 return False
-            if not keep_function_call and item.type in [
-                "function_call",
-                "function_call_output",
-            ]:
+            if not keep_function_call and itm_type in _FC_TYPES:
                 return False
             return True
 
-        new_items: list[llm.ChatItem] = []
-        # Recorre al revés para ir cogiendo los últimos mensajes
-        for item in reversed(items):
-            if _valid_item(item):
-                new_items.append(item)
-            if len(new_items) >= keep_last_n_messages:
-                break
-
-        # Volvemos a ponerlos en orden cronológico
-        new_items = new_items[::-1]
-
-        # No queremos que el contexto recortado empiece por function_call
-        while new_items and new_items[0].type in ["function_call", "function_call_output"]:
-            new_items.pop(0)
-
-        return new_items
+        def _recent_items(n: int) -> tuple[deque[llm.ChatItem], int]:
+            """
+            Últimos `n` items válidos en orden cronológico, y el índice en `items`
+            a partir del cual se han cogido.
+            """
+            recent: deque[llm.ChatItem] = deque()
+            tail_start = len(items)
+            # Recorre al revés; appendleft los deja ya en orden cronológico
+            for idx in range(len(items) - 1, -1, -1):
+                if len(recent) >= n:
+                    break
+                tail_start = idx
+                if _valid_item(items[idx]):
+                    recent.appendleft(items[idx])
+
+            # No queremos que el contexto recortado empiece por una function_call
+            # huérfana: una salida sin su llamada o una llamada sin su salida
+            output_ids = {item.call_id for item in recent if item.type == "function_call_output"}
+            while recent and (
+                recent[0].type == "function_call_output"
+                or (recent[0].type == "function_call" and recent[0].call_id not in output_ids)
+            ):
+                recent.popleft()
+            return recent, tail_start
+
+        if not relevance_context or keep_relevant_n <= 0:
+            return list(_recent_items(keep_last_n_messages)[0])
+
+        # Los mensajes relevantes salen del mismo presupuesto de N items:
+        # N - k recientes + hasta k anteriores relevantes
+        k = min(keep_relevant_n, keep_last_n_messages)
+        new_items, tail_start = _recent_items(keep_last_n_messages - k)
+        older = [
+            item
+            for item in items[:tail_start]
+            if item.type == "message" and _valid_item(item)
+        ]
+        relevant = self._select_relevant_items(older, relevance_context, k)
+
+        # Si hay menos de k relevantes, los huecos se rellenan con recientes
+        if len(relevant) < k:
+            new_items, _ = _recent_items(keep_last_n_messages - len(relevant))
+            recent_ids = {item.id for item in new_items}
+            relevant = [item for item in relevant if item.id not in recent_ids]
+
+        new_items.extendleft(reversed(relevant))
+        return list(new_items)
+
+    def _select_relevant_items(
+        self,
+        items: list[llm.ChatItem],
+        relevance_context: str,
+        top_k: int,
+    ) -> list[llm.ChatItem]:
+        """
+        Selecciona hasta `top_k` mensajes con alguna palabra en común con `relevance_context`,
+        priorizando los que más comparten (a igualdad, los más recientes),
+        y los devuelve en orden cronológico.
+        """
+        context_words = _tokenize(relevance_context)
+        scores = [len(context_words & _tokenize(item.text_content or "")) for item in items]
+        ranked = sorted(
+            (i for i, score in enumerate(scores) if score > 0),
+            key=lambda i: (scores[i], i),
+            reverse=True,
+        )
+        return [items[i] for i in sorted(ranked[:top_k])]
 
 
 # ====================== #
 #        GREETER         #
 # ====================== #
 
+_GREETER_INSTRUCTIONS_TEMPLATE = (
+    "Eres un amable recepcionista del restaurante MDS10. El menú es: {menu}\n"
+    "Tu trabajo es saludar a quien llama y entender si quieren "
+    "hacer una reserva o pedir comida para llevar. Guíalos al agente adecuado usando las herramientas."
+)
+
+
 class Greeter(BaseAgent):
     """
     Agente recepcionista:
@@ -171,19 +277,10 @@ class Greeter(BaseAgent):
       - Decide si va a reservas o a takeaway usando tools.
     """
 
-    def __init__(self, menu: str) -> None:
+    def __init__(self, menu: str, tts: elevenlabs.TTS) -> None:
         super().__init__(
-            instructions=(
-                f"Eres un amable recepcionista del restaurante MDS10. El menú es: {menu}\n"
-                "Tu trabajo es saludar a quien llama y entender si quieren "
-                "hacer una reserva o pedir comida para llevar. Guíalos al agente adecuado usando las herramientas."
-            ),
-            llm=openai.LLM(model="gpt-4o-mini", parallel_tool_calls=False),
-            tts=elevenlabs.TTS(
-            voice_id="Ir1QNHvhaJXbAGhT50w3",
-            model="eleven_turbo_v2_5",
-
-            ),
+            instructions=_GREETER_INSTRUCTIONS_TEMPLATE.format(menu=menu),
+            tts=tts,
         )
         self.menu = menu
 
@@ -208,6 +305,22 @@ class Greeter(BaseAgent):
 #      RESERVATION       #
 # ====================== #
 
+_RESERVATION_INSTRUCTIONS = (
+    "Eres un agente de reservas en un restaurante. Tu trabajo es preguntar primero "
+    "por la fecha y la hora de la reserva, luego por el nombre del cliente y, por último, "
+    "por el número de teléfono. Después, debes repetir y confirmar todos los datos con el cliente.\n\n"
+    "Instrucciones de formato para los números:\n"
+    "- Cuando escribas números de teléfono, represéntalos siempre dígito a dígito separados por espacios, "
+    "por ejemplo: '6 1 2  3 4 5  6 7 8'.\n"
+    "- No utilices símbolos como '+', '-', '=', '*', 'x', '/', ni otros caracteres extraños en los números.\n"
+    "- Cuando hables de horas, utiliza una forma natural en español, por ejemplo: "
+    "'a las ocho', 'a las ocho y media de la tarde', en lugar de '20:30'.\n"
+    "- Si algún número no se entiende claramente, pide al cliente que lo repita dígito a dígito.\n"
+    "Tu tono debe ser educado, claro y directo, y siempre debes verificar que los datos de la reserva "
+    "son correctos antes de finalizar la conversación."
+)
+
+
 class Reservation(BaseAgent):
     """
     Agente encargado de gestionar reservas:
@@ -216,27 +329,11 @@ class Reservation(BaseAgent):
       - Al confirmar, puede devolver al greeter.
     """
 
-    def __init__(self) -> None:
+    def __init__(self, tts: elevenlabs.TTS) -> None:
         super().__init__(
-            instructions=(
-                "Eres un agente de reservas en un restaurante. Tu trabajo es preguntar primero "
-                "por la fecha y la hora de la reserva, luego por el nombre del cliente y, por último, "
-                "por el número de teléfono. Después, debes repetir y confirmar todos los datos con el cliente.\n\n"
-                "Instrucciones de formato para los números:\n"
-                "- Cuando escribas números de teléfono, represéntalos siempre dígito a dígito separados por espacios, "
-                "por ejemplo: '6 1 2  3 4 5  6 7 8'.\n"
-                "- No utilices símbolos como '+', '-', '=', '*', 'x', '/', ni otros caracteres extraños en los números.\n"
-                "- Cuando hables de horas, utiliza una forma natural en español, por ejemplo: "
-                "'a las ocho', 'a las ocho y media de la tarde', en lugar de '20:30'.\n"
-                "- Si algún número no se entiende claramente, pide al cliente que lo repita dígito a dígito.\n"
-                "Tu tono debe ser educado, claro y directo, y siempre debes verificar que los datos de la reserva "
-                "son correctos antes de finalizar la conversación."
-            ),
+            instructions=_RESERVATION_INSTRUCTIONS,
             tools=[update_name, update_phone, to_greeter],
-            tts=elevenlabs.TTS(
-            voice_id="Ir1QNHvhaJXbAGhT50w3",
-            model="eleven_turbo_v2_5",
-            )
+            tts=tts,
         )
 
     @function_tool()
@@ -273,6 +370,13 @@ class Reservation(BaseAgent):
 #        TAKEAWAY        #
 # ====================== #
 
+_TAKEAWAY_INSTRUCTIONS_TEMPLATE = (
+    "Eres un agente de comida para llevar que toma pedidos de los clientes. "
+    "Nuestro menú es: {menu}\n"
+    "Aclara peticiones especiales y confirma el pedido con el cliente."
+)
+
+
 class Takeaway(BaseAgent):
     """
     Agente encargado de pedidos de comida para llevar:
@@ -281,18 +385,11 @@ class Takeaway(BaseAgent):
       - Puede enviar al checkout cuando el usuario quiera pagar.
     """
 
-    def __init__(self, menu: str) -> None:
+    def __init__(self, menu: str, tts: elevenlabs.TTS) -> None:
         super().__init__(
-            instructions=(
-                f"Eres un agente de comida para llevar que toma pedidos de los clientes. "
-                f"Nuestro menú es: {menu}\n"
-                "Aclara peticiones especiales y confirma el pedido con el cliente."
-            ),
+            instructions=_TAKEAWAY_INSTRUCTIONS_TEMPLATE.format(menu=menu),
             tools=[to_greeter],
-            tts=elevenlabs.TTS(
-            voice_id="Ir1QNHvhaJXbAGhT50w3",
-            model="eleven_turbo_v2_5",
-            )
+            tts=tts,
         )
 
     @function_tool()
@@ -324,6 +421,23 @@ class Takeaway(BaseAgent):
 #        CHECKOUT        #
 # ====================== #
 
+_CHECKOUT_INSTRUCTIONS_TEMPLATE = (
+    "Eres un agente para realizar pagos en un restaurante. El menú es: {menu}\n"
+    "Tu responsabilidad es confirmar el coste total del pedido y luego recopilar "
+    "el nombre del cliente, número de teléfono e información de la tarjeta de crédito, "
+    "incluyendo el número de tarjeta, fecha de caducidad y CVV paso a paso.\n"
+    "Una vez recopilada toda la información, confirma el pago y despide al cliente.\n"
+    "- Cuando escribas números de teléfono, represéntalos siempre dígito a dígito separados por espacios, "
+    "por ejemplo: '6 1 2  3 4 5  6 7 8'.\n"
+    "Muy importante: cuando expliques los importes o el cálculo del total, NO uses "
+    "símbolos como '=', '+', '-', '*', 'x' ni otros caracteres especiales. "
+    "En su lugar, usa solo lenguaje natural en español, por ejemplo: "
+    "'la suma de los platos es...', 'el total a pagar es...'. "
+    "Evita también escribir fórmulas matemáticas o listas con signos; responde siempre "
+    "en frases completas y conversacionales."
+)
+
+
 class Checkout(BaseAgent):
     """
     Agente de pago:
@@ -332,28 +446,11 @@ class Checkout(BaseAgent):
       - Cuando todo está OK, marca checked_out y devuelve al greeter.
     """
 
-    def __init__(self, menu: str) -> None:
+    def __init__(self, menu: str, tts: elevenlabs.TTS) -> None:
         super().__init__(
-            instructions=(
-            f"Eres un agente para realizar pagos en un restaurante. El menú es: {menu}\n"
-            "Tu responsabilidad es confirmar el coste total del pedido y luego recopilar "
-            "el nombre del cliente, número de teléfono e información de la tarjeta de crédito, "
-            "incluyendo el número de tarjeta, fecha de caducidad y CVV paso a paso.\n"
-            "Una vez recopilada toda la información, confirma el pago y despide al cliente.\n"
-            "- Cuando escribas números de teléfono, represéntalos siempre dígito a dígito separados por espacios, "
-            "por ejemplo: '6 1 2  3 4 5  6 7 8'.\n"
-            "Muy importante: cuando expliques los importes o el cálculo del total, NO uses "
-            "símbolos como '=', '+', '-', '*', 'x' ni otros caracteres especiales. "
-            "En su lugar, usa solo lenguaje natural en español, por ejemplo: "
-            "'la suma de los platos es...', 'el total a pagar es...'. "
-            "Evita también escribir fórmulas matemáticas o listas con signos; responde siempre "
-            "en frases completas y conversacionales."
-        ),
+            instructions=_CHECKOUT_INSTRUCTIONS_TEMPLATE.format(menu=menu),
             tools=[update_name, update_phone, to_greeter],
-            tts=elevenlabs.TTS(
-            voice_id="Ir1QNHvhaJXbAGhT50w3",
-            model="eleven_turbo_v2_5",
-            )
+            tts=tts,
         )
 
     @function_tool()
@@ -405,7 +502,8 @@ class Checkout(BaseAgent):
             return "Please provide the credit card information first."
 
         userdata.checked_out = True
-        return await to_greeter(context)
+        # Ya sabemos que el agente actual es Checkout: transferimos directamente
+        return await self._transfer_to_agent("greeter", context)
 
     @function_tool()
     async def to_takeaway(self, context: RunContext_T) -> tuple[Agent, str]:
@@ -419,6 +517,16 @@ class Checkout(BaseAgent):
 #      ENTRYPOINT        #
 # ====================== #
 
+def prewarm(proc: JobProcess):
+    """
+    Función de prewarm que se ejecuta una vez por proceso del worker.
+    Carga el modelo VAD de Silero y el cliente de OpenAI y los guarda en
+    `proc.userdata` para reutilizarlos en todas las sesiones de este proceso.
+    """
+    proc.userdata["vad"] = silero.VAD.load()
+    proc.userdata["llm"] = openai.LLM(model="gpt-4o-mini")
+
+
 async def entrypoint(ctx: JobContext):
     """
     Función de entrada del worker de LiveKit.
@@ -427,7 +535,25 @@ async def entrypoint(ctx: JobContext):
     - Crea la sesión de agente de voz.
     - Arranca con el agente greeter.
     """
-    await ctx.connect()
+    # Abre en segundo plano la conexión con OpenAI mientras se conecta al room
+    # y al TTS, para que la primera respuesta del greeter no pague el handshake
+    warm_up_task = asyncio.create_task(warm_up_llm(ctx.proc.userdata["llm"]))
+
+    async def cancel_warm_up():
+        """
+        Shutdown callback: cancela el warm-up si el job termina antes de que acabe.
+        """
+        warm_up_task.cancel()
+
+    ctx.add_shutdown_callback(cancel_warm_up)
+
+    # Un único cliente TTS por job, compartido por todos los agentes,
+    # así la conexión con ElevenLabs se mantiene abierta en las transferencias.
+    # La conexión al room y la del TTS se abren a la vez.
+    _, shared_tts = await asyncio.gather(
+        ctx.connect(),
+        make_tts(),
+    )
 
     # Menú de ejemplo que se pasa a algunos agentes
     menu = "Pizza: 10 euros, Ensalada: 5 euros, Helado: 3 euros, Café: 2 euros"
@@ -436,10 +562,10 @@ async def entrypoint(ctx: JobContext):
     userdata = UserData()
     userdata.agents.update(
         {
-            "greeter": Greeter(menu),
-            "reservation": Reservation(),
-            "takeaway": Takeaway(menu),
-            "checkout": Checkout(menu),
+            "greeter": Greeter(menu, tts=shared_tts),
+            "reservation": Reservation(tts=shared_tts),
+            "takeaway": Takeaway(menu, tts=shared_tts),
+            "checkout": Checkout(menu, tts=shared_tts),
         }
     )
 
@@ -448,16 +574,23 @@ async def entrypoint(ctx: JobContext):
     #   - LLM (OpenAI)
     #   - TTS (ElevenLabs)
     #   - VAD (Silero)
+    #   - Detección de turnos (MultilingualModel)
     agent = AgentSession[UserData](
         userdata=userdata,
+        # STT por job: usa la sesión HTTP del job, que se cierra al terminar
         stt=deepgram.STT(model="nova-3-general", language="es"),
-        llm=openai.LLM(model="gpt-4o-mini"),
-        tts=elevenlabs.TTS(
-            voice_id="Ir1QNHvhaJXbAGhT50w3",
-            model="eleven_turbo_v2_5",
-        ),
-        vad=silero.VAD.load(),
+        # LLM con caché para el saludo inicial (sin mensajes del usuario)
+        llm=CachedLLM(ctx.proc.userdata["llm"]),
+        tts=shared_tts,
+        vad=ctx.proc.userdata["vad"],  # VAD precargado en prewarm
+        # El detector de turnos decide cuándo ha terminado el usuario;
+        # el silencio mínimo queda sólo como red de seguridad
+        turn_detection=MultilingualModel(),
+        min_endpointing_delay=0.05,
         max_tool_steps=5,
+        # Empieza a generar la respuesta con la transcripción parcial,
+        # antes de confirmar que el usuario ha terminado de hablar
+        preemptive_generation=True,
     )
 
     # Inicia la sesión con el agente "greeter"
@@ -475,5 +608,10 @@ async def entrypoint(ctx: JobContext):
 # ====================== #
 
 if __name__ == "__main__":
-    # Lanza el worker de LiveKit con la función entrypoint
-    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint))
+    # Lanza el worker de LiveKit con la función entrypoint y el prewarm
+    cli.run_app(
+        WorkerOptions(
+            entrypoint_fnc=entrypoint,
+            prewarm_fnc=prewarm,
+        )
+    )
@@ -0,0 +1,194 @@
+import dataclasses
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from livekit.agents.llm import (
+    LLM,
+    ChatChunk,
+    ChatContext,
+    FunctionTool,
+    LLMStream,
+    RawFunctionTool,
+    ToolChoice,
+    ToolContext,
+)
+from livekit.agents.types import (
+    DEFAULT_API_CONNECT_OPTIONS,
+    NOT_GIVEN,
+    APIConnectOptions,
+    NotGivenOr,
+)
+from livekit.agents.utils import is_given
+
+
+class ResponseCache:
+    """
+    In-memory LRU cache of LLM responses with a TTL.
+    Keys are SHA256 hashes of (model, messages, tools, tool_choice).
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 3600.0) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, list[ChatChunk]]] = OrderedDict()
+
+    def get(self, key: str) -> Optional[list[ChatChunk]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        stored_at, chunks = entry
+        if time.monotonic() - stored_at > self._ttl:
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return chunks
+
+    def put(self, key: str, chunks: list[ChatChunk]) -> None:
+        self._entries[key] = (time.monotonic(), chunks)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+
+# Cache shared by every CachedLLM of the worker process unless one is injected
+_default_cache = ResponseCache()
+
+
+class CachedLLM(LLM):
+    """
+    Wraps an LLM and replays cached responses for turns without any user
+    message yet (e.g. the opening greeting of an agent). Those contexts only
+    hold instructions, so the key can repeat across sessions and no user
+    data ends up in the cache. Every other turn goes to the wrapped LLM.
+    Only text-only responses are stored.
+    """
+
+    def __init__(
+        self,
+        llm: LLM,
+        *,
+        cache: Optional[ResponseCache] = None,
+    ) -> None:
+        super().__init__()
+        self._llm = llm
+        self._cache = cache if cache is not None else _default_cache
+
+    @property
+    def model(self) -> str:
+        return self._llm.model
+
+    @property
+    def provider(self) -> str:
+        return self._llm.provider
+
+    def chat(
+        self,
+        *,
+        chat_ctx: ChatContext,
+        tools: Optional[list[FunctionTool | RawFunctionTool]] = None,
+        conn_options: APIConnectOptions = DEFAULT_API_CONNECT_OPTIONS,
+        parallel_tool_calls: NotGivenOr[bool] = NOT_GIVEN,
+        tool_choice: NotGivenOr[ToolChoice] = NOT_GIVEN,
+        extra_kwargs: NotGivenOr[dict[str, Any]] = NOT_GIVEN,
+    ) -> LLMStream:
+        return _CachedLLMStream(
+            self,
+            chat_ctx=chat_ctx,
+            tools=tools or [],
+            conn_options=conn_options,
+            parallel_tool_calls=parallel_tool_calls,
+            tool_choice=tool_choice,
+            extra_kwargs=extra_kwargs,
+        )
+
+    def prewarm(self) -> None:
+        self._llm.prewarm()
+
+    async def aclose(self) -> None:
+        await self._llm.aclose()
+
+    def _is_cacheable(self, chat_ctx: ChatContext) -> bool:
+        return not any(item.type == "message" and item.role == "user" for item in chat_ctx.items)
+
+    def _cache_key(
+        self,
+        chat_ctx: ChatContext,
+        tools: list[FunctionTool | RawFunctionTool],
+        tool_choice: NotGivenOr[ToolChoice],
+    ) -> str:
+        # Item ids and call ids are random per session, they must not be part of the key
+        messages = [
+            {k: v for k, v in item.items() if k not in ("id", "call_id")}
+            for item in chat_ctx.to_dict(exclude_timestamp=True)["items"]
+        ]
+        payload = {
+            "model": self._llm.model,
+            "messages": messages,
+            "tools": sorted(ToolContext(tools).function_tools),
+            "tool_choice": tool_choice if is_given(tool_choice) else None,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class _CachedLLMStream(LLMStream):
+    def __init__(
+        self,
+        llm: CachedLLM,
+        *,
+        chat_ctx: ChatContext,
+        tools: list[FunctionTool | RawFunctionTool],
+        conn_options: APIConnectOptions,
+        parallel_tool_calls: NotGivenOr[bool],
+        tool_choice: NotGivenOr[ToolChoice],
+        extra_kwargs: NotGivenOr[dict[str, Any]],
+    ) -> None:
+        # Retries are handled by the wrapped LLM stream
+        super().__init__(
+            llm,
+            chat_ctx=chat_ctx,
+            tools=tools,
+            conn_options=dataclasses.replace(conn_options, max_retry=0),
+        )
+        self._cached_llm = llm
+        self._inner_conn_options = conn_options
+        self._parallel_tool_calls = parallel_tool_calls
+        self._tool_choice = tool_choice
+        self._extra_kwargs = extra_kwargs
+
+    async def _run(self) -> None:
+        cached_llm = self._cached_llm
+        key = None
+        if cached_llm._is_cacheable(self._chat_ctx):
+            key = cached_llm._cache_key(self._chat_ctx, self._tools, self._tool_choice)
+            chunks = cached_llm._cache.get(key)
+            if chunks is not None:
+                for chunk in chunks:
+                    self._event_ch.send_nowait(chunk)
+                return
+
+        recorded: list[ChatChunk] = []
+        has_tool_calls = False
+        async with cached_llm._llm.chat(
+            chat_ctx=self._chat_ctx,
+            tools=self._tools,
+            conn_options=self._inner_conn_options,
+            parallel_tool_calls=self._parallel_tool_calls,
+            tool_choice=self._tool_choice,
+            extra_kwargs=self._extra_kwargs,
+        ) as stream:
+            async for chunk in stream:
+                self._event_ch.send_nowait(chunk)
+                if chunk.delta is None:
+                    continue
+                if chunk.delta.tool_calls:
+                    has_tool_calls = True
+                # Usage is not replayed, a cache hit costs no tokens
+                recorded.append(chunk.model_copy(update={"usage": None}))
+
+        if key is not None and recorded and not has_tool_calls:
+            cached_llm._cache.put(key, recorded)
@@ -3,8 +3,11 @@ from livekit.agents.voice import Agent
 from typing import Optional
 import yaml
 
+# fields that are not part of summarize() and must not invalidate its cache
+_UNVERSIONED_FIELDS = frozenset({"agents", "prev_agent", "_version", "_summary_cache"})
 
-@dataclass
+
+@dataclass(slots=True)
 class UserData:
     customer_name: Optional[str] = None
     customer_phone: Optional[str] = None
@@ -23,21 +26,36 @@ class UserData:
     agents: dict[str, Agent] = field(default_factory=dict)
     prev_agent: Optional[Agent] = None
 
+    # bumped on every change of a summarized field, used to memoize summarize()
+    _version: int = field(default=0, init=False, repr=False, compare=False)
+    _summary_cache: tuple[int, str] = field(default=(-1, ""), init=False, repr=False, compare=False)
+
+    def __setattr__(self, name: str, value) -> None:
+        object.__setattr__(self, name, value)
+        if name not in _UNVERSIONED_FIELDS:
+            object.__setattr__(self, "_version", getattr(self, "_version", 0) + 1)
+
+    def cached_summary(self) -> str:
+        if self._summary_cache[0] != self._version:
+            self._summary_cache = (self._version, self.summarize())
+        return self._summary_cache[1]
+
     def summarize(self) -> str:
+        card = self.customer_credit_card
         data = {
             "nombre_cliente": self.customer_name or "desconocido",
             "telefono_cliente": self.customer_phone or "desconocido",
             "hora_reserva": self.reservation_time or "desconocido",
             "pedido": self.order or "desconocido",
             "tarjeta_credito": {
-            "numero": self.customer_credit_card or "desconocido",
+            "numero": card,
             "caducidad": self.customer_credit_card_expiry or "desconocido",
             "cvv": self.customer_credit_card_cvv or "desconocido",
             }
-            if self.customer_credit_card
+            if card
             else None,
             "importe": self.expense or "desconocido",
             "pagado": self.checked_out or False,
         }
         # summarize in yaml performs better than json
-        return yaml.dump(data)
\ No newline at end of file
+        return yaml.dump(data)
@@ -0,0 +1,34 @@
+import logging
+
+from livekit.agents import tokenize
+from livekit.plugins import elevenlabs
+
+logger = logging.getLogger("tts")
+
+# In auto_mode ElevenLabs flushes after every sentence; sentences shorter than
+# this are merged with the next one, so keep it low for a fast first phrase
+MIN_SENTENCE_LEN = 8
+
+
+async def open_tts(voice_id: str, model: str) -> elevenlabs.TTS:
+    """
+    Creates an ElevenLabs TTS for the current job and opens its WebSocket.
+
+    Must be called from the job's entrypoint: the TTS uses the job's HTTP
+    session, which is closed when the job ends. Within the job the instance
+    is shared by every agent, so the socket stays open across hand-offs.
+    """
+    tts = elevenlabs.TTS(
+        voice_id=voice_id,
+        model=model,
+        auto_mode=True,
+        word_tokenizer=tokenize.blingfire.SentenceTokenizer(
+            min_sentence_len=MIN_SENTENCE_LEN,
+        ),
+    )
+    try:
+        # Open the WebSocket now so the first sentence doesn't pay the handshake
+        await tts.current_connection()
+    except Exception:
+        logger.warning("could not pre-open ElevenLabs connection", exc_info=True)
+    return tts
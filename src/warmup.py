@@ -0,0 +1,24 @@
+import logging
+
+from livekit.agents.llm import LLM, ChatContext
+
+logger = logging.getLogger("warmup")
+
+
+async def warm_up_llm(llm: LLM) -> None:
+    """
+    Sends a one-token request so DNS, TLS and auth with the LLM provider are
+    already done when the first real turn arrives. Errors are only logged:
+    the first turn will simply pay the connection setup.
+    """
+    chat_ctx = ChatContext.empty()
+    chat_ctx.add_message(role="user", content=".")
+    try:
+        async with llm.chat(
+            chat_ctx=chat_ctx,
+            extra_kwargs={"max_completion_tokens": 1},
+        ) as stream:
+            async for _ in stream:
+                pass
+    except Exception:
+        logger.warning("LLM warm-up request failed", exc_info=True)